@@ -0,0 +1,47 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""Compiled counterpart of paths.utils._base36_path_decode."""
+
+
+# Maps an ASCII byte to its base36 digit value, or 0xFF for bytes that are not base36 digits.
+cdef unsigned char DIGIT_VALUES[256]
+DIGIT_VALUES[:] = [0xFF] * 256
+for _i in range(10):
+    DIGIT_VALUES[0x30 + _i] = _i  # '0'-'9'
+for _i in range(26):
+    DIGIT_VALUES[0x41 + _i] = 10 + _i  # 'A'-'Z'
+    DIGIT_VALUES[0x61 + _i] = 10 + _i  # 'a'-'z', as accepted by int(s, 36)
+
+
+cpdef list decode(const unsigned char[:] buf):
+    """Decodes length-prefixed base36 ids from ASCII bytes into a list of integers."""
+
+    cdef Py_ssize_t end = buf.shape[0]
+    cdef Py_ssize_t cursor = 0
+    cdef Py_ssize_t start, stop
+    cdef unsigned long long value
+    cdef unsigned char c
+    cdef list ids = []
+
+    while cursor < end:
+        # A single length digit bounds each id to 9 base36 characters,
+        # which always fits in 64 bits.
+        c = buf[cursor]
+        if c < 0x31 or c > 0x39:
+            raise ValueError("Invalid length prefix in path.")
+
+        start = cursor + 1
+        stop = start + (c - 0x30)
+        if stop > end:
+            raise ValueError("Truncated path.")
+
+        value = 0
+        for cursor in range(start, stop):
+            c = DIGIT_VALUES[buf[cursor]]
+            if c == 0xFF:
+                raise ValueError("Invalid base36 digit in path.")
+            value = value * 36 + c
+
+        ids.append(value)
+        cursor = stop
+
+    return ids
@@ -1,18 +1,71 @@
-from django.db import models
-from django.db.models import F, Func, Value
+from django.db import models, transaction
+from django.db.models import DEFERRED, Case, Exists, F, OuterRef, Q, Value, When
+from django.db.models.functions import Cast, Concat, Length, Substr
 from django.core.exceptions import ValidationError
-from paths.utils import base36decode, base36encode, xstr
+from paths.utils import base36decode, base36encode, base36_path_decode, xstr
+
+
+class BaseNodeQuerySet(models.QuerySet):
+
+    def ancestors_of(self, outer_path_field='path'):
+        """
+        Filters to the ancestors of the outer query's node, for use inside Subquery/Exists.
+
+        The children of an ancestor store ``<ancestor path><encoded ancestor id>`` as their path,
+        which is a prefix of every descendant's path. Ancestors are therefore the parents of the
+        nodes whose path prefixes the outer path, so no id decoding happens in SQL. Those paths
+        sort between the outer path's first segment and the outer path itself, which bounds the
+        lookup to an index range within the outer node's tree.
+
+        :param outer_path_field: The name of the path field on the outer query. Defaults to 'path'
+        :return: A queryset of ancestors correlated with the outer query
+        """
+        outer_path = OuterRef(OuterRef(outer_path_field))
+        first_segment = Substr(
+            outer_path, 1, Cast(Substr(outer_path, 1, 1), models.IntegerField()) + 1)
+
+        prefixes = self.model.objects.filter(
+            path__gte=first_segment,
+            path__lte=outer_path,
+            path=Substr(outer_path, 1, Length('path')),
+        ).values('parent_id')
+
+        return self.filter(pk__in=prefixes)
+
+    def with_has_children(self):
+        """
+        Annotates each node with whether it has children, which has_children() then reads
+        instead of querying once per node.
+
+        :return: A queryset annotated with ``_has_children``
+        """
+        return self.annotate(
+            _has_children=Exists(self.model.objects.filter(parent_id=OuterRef('pk'))))
 
 
 class BaseNode(models.Model):
     """Abstract class for implementing a simple materialized path hierarchy."""
 
+    # Paths only contain ASCII digits and letters, so a varchar already stores one
+    # byte per character; max_length caps the depth and reserves no space.
     path = models.CharField(
         max_length=255, db_index=True, null=True, blank=True)
     parent = models.ForeignKey(
         'self', on_delete=models.CASCADE, related_name="children", null=True, blank=True)
 
-    _original_parent_id = None  # The parent_id when instantiated
+    objects = BaseNodeQuerySet.as_manager()
+
+    # Moves of subtrees larger than this rewrite descendant paths in batches
+    # of this many rows. None rewrites them in a single UPDATE.
+    path_update_batch_size = 5000
+
+    # The parent_id when loaded or last saved. DEFERRED until known, e.g. for rows
+    # from bulk_create(), so save() fetches it instead of assuming a move.
+    _original_parent_id = DEFERRED
+    _path_ids_cache = None  # Decoded ids of _path_ids_cache_for
+    _path_ids_cache_for = None  # The path _path_ids_cache was decoded from
+    _ancestors_cache = None  # Ancestors of _ancestors_cache_for, root first
+    _ancestors_cache_for = None  # The path _ancestors_cache was fetched for
 
     class Meta:
         abstract = True
@@ -23,15 +76,44 @@ class BaseNode(models.Model):
         :return: The depth of self in the tree starting with root at 0.
         """
 
-        if not self.path:
+        path = self.path
+        if not path:
             return 0
 
-        ids = self.decode_path_to_ids(self.path)
-        return len(ids)
+        # Hop from one length prefix to the next without decoding any ids.
+        end = len(path)
+        cursor = 0
+        depth = 0
+        while cursor < end:
+            length = ord(path[cursor]) - 0x30
+            if not 1 <= length <= 9:
+                raise ValueError("Invalid length prefix in path.")
+            cursor += length + 1
+            depth += 1
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._original_parent_id = self.parent_id
+        return depth
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Snapshot here rather than in __init__ so fetched rows skip an extra frame,
+        # and a deferred parent_id is only loaded if the instance is saved.
+        instance._original_parent_id = instance.__dict__.get('parent_id', DEFERRED)
+        return instance
+
+    def _ids(self):
+        """
+        Decodes self.path, reusing the previous result while the path is unchanged.
+
+        :return: A list of ordered int ids. Callers must not mutate it.
+        """
+        ids = self._path_ids_cache
+        if ids is None or self._path_ids_cache_for != self.path:
+            ids = self.decode_path_to_ids(self.path)
+            self._path_ids_cache = ids
+            self._path_ids_cache_for = self.path
+
+        return ids
 
     @classmethod
     def encode_base36_id(cls, num):
@@ -41,8 +123,8 @@ class BaseNode(models.Model):
         :param num: An integer value representing the object's id
         :return: An encoded string
         """
-        num = base36encode(num)
-        return str(len(num)) + num
+        encoded = base36encode(num)
+        return f"{len(encoded)}{encoded}"
 
     @classmethod
     def decode_base36_id(cls, base36_id):
@@ -57,24 +139,15 @@ class BaseNode(models.Model):
     @classmethod
     def decode_path_to_ids(cls, path):
         """
-        Decodes a full 'path' into an ordered list of ids using decode_base36_id.
+        Decodes a full 'path' into an ordered list of ids.
 
         :param path: A string path of concatenated values from encode_base36_id
         :return: A list of ordered int ids
         """
-        cursor = 1
-        ids = []
-
         if not path:
-            return ids
+            return []
 
-        while cursor < len(path):
-            b36len = int(path[cursor - 1])
-            b36str = path[cursor:cursor + b36len]
-            ids.append(cls.decode_base36_id(b36str))
-            cursor = cursor + b36len + 1
-
-        return ids
+        return base36_path_decode(path.encode('ascii'))
 
     @classmethod
     def encode_ids_to_path(cls, ids):
@@ -84,11 +157,7 @@ class BaseNode(models.Model):
         :param ids: A list of ordered int ids
         :return: A string path of concatenated values from encode_base36_id
         """
-        path = ''
-        for id_ in ids:
-            path = path + cls.encode_base36_id(id_)
-
-        return path
+        return ''.join(cls.encode_base36_id(id_) for id_ in ids)
 
     def get_ancestors_ids(self, include_self=False):
         """
@@ -98,7 +167,7 @@ class BaseNode(models.Model):
         if not self.path and not include_self:
             return []
 
-        ids = self.decode_path_to_ids(self.path)
+        ids = list(self._ids())
 
         if include_self:
             ids.append(self.id)
@@ -116,6 +185,33 @@ class BaseNode(models.Model):
 
         return self.__class__.objects.filter(pk__in=ids).all()
 
+    def get_ancestors_ordered(self):
+        """
+        Fetches all ancestors not including self in a single query. The result is kept on self
+        until its path changes, after which get_ancestor() also reads from it.
+
+        :return: A list of ancestors ordered from root to parent or empty list
+        :raise: DoesNotExist: If an ancestor in self path no longer exists
+        """
+        ids = self._ids()
+
+        if not ids:
+            return []
+
+        if self._ancestors_cache is None or self._ancestors_cache_for != self.path:
+            by_id = self.__class__.objects.in_bulk(ids)
+
+            # Skipping missing rows would shift the depths get_ancestor() reads from the cache.
+            missing = [id_ for id_ in ids if id_ not in by_id]
+            if missing:
+                raise self.DoesNotExist(
+                    f"Ancestors {missing} of {self.__class__.__name__} {self.pk} do not exist.")
+
+            self._ancestors_cache = [by_id[id_] for id_ in ids]
+            self._ancestors_cache_for = self.path
+
+        return list(self._ancestors_cache)
+
     def get_ancestor(self, depth: int = 0):
         """
         Fetches the ancestor at a specific depth.
@@ -127,18 +223,21 @@ class BaseNode(models.Model):
         if depth < 0:
             raise ValueError(f"The minimum depth is 0 - {depth} given.")
 
-        if depth is 0:
+        if depth == 0:
             return self.get_root()
 
         self_depth = self.depth
-        if self_depth is depth:
+        if self_depth == depth:
             return self
 
         if self_depth < depth:
             raise ValueError(
                 'Cannot find ancestor at depth greater than or equal to self depth.')
 
-        ids = self.decode_path_to_ids(self.path)
+        if self._ancestors_cache is not None and self._ancestors_cache_for == self.path:
+            return self._ancestors_cache[depth]
+
+        ids = self._ids()
         return self.__class__.objects.get(pk=ids[depth])
 
     def get_descendants_search_partial(self):
@@ -159,9 +258,19 @@ class BaseNode(models.Model):
         """
         search_partial = self.get_descendants_search_partial()
         descendants = self.__class__.objects.filter(
-            path__startswith=search_partial).values_list('id', flat=True).all()
+            path__startswith=search_partial).order_by().values_list('id', flat=True)
         return list(descendants)
 
+    def get_root_id(self):
+        """
+        :return: The int id of the root ancestor, or self id (if self is root)
+        """
+
+        if not self.path:
+            return self.id
+
+        return self._ids()[0]
+
     def get_root(self):
         """
         Fetches the root ancestor.
@@ -172,8 +281,7 @@ class BaseNode(models.Model):
         if not self.path:
             return self
 
-        root_id = self.decode_path_to_ids(self.path)[0]
-        return self.__class__.objects.get(id=root_id)
+        return self.__class__.objects.get(pk=self.get_root_id())
 
     def get_siblings(self):
         """
@@ -200,12 +308,22 @@ class BaseNode(models.Model):
         :return: ``True`` if self is descendant of ancestor, else ``False``
         """
 
-        if not self.path:
+        path = self.path
+        if not path or not isinstance(ancestor_id, int) or ancestor_id < 0:
             return False
 
-        ids = self.decode_path_to_ids(self.path)
-        if ancestor_id in ids:
-            return True
+        # Compare the encoded id against each segment in place. The needle
+        # carries its own length prefix, so only whole segments can match.
+        needle = self.encode_base36_id(ancestor_id)
+        end = len(path)
+        cursor = 0
+        while cursor < end:
+            if path.startswith(needle, cursor):
+                return True
+            length = ord(path[cursor]) - 0x30
+            if not 1 <= length <= 9:
+                raise ValueError("Invalid length prefix in path.")
+            cursor += length + 1
 
         return False
 
@@ -215,47 +333,202 @@ class BaseNode(models.Model):
 
         :return: ``True`` if self has descendants, else ``False``
         """
+        has_children = getattr(self, '_has_children', None)
+        if has_children is not None:
+            return has_children
+
         if self.children.exists():
             return True
 
         return False
 
+    @classmethod
+    def bulk_reparent(cls, moves):
+        """
+        Moves several nodes at once with one UPDATE for the moved nodes and one for all of their
+        descendants, instead of one save() per node. Like QuerySet.update(), this does not call
+        save() or send signals. The given instances are updated in place.
+
+        :param moves: An iterable of (node, new parent or None) pairs
+        :raise: ValidationError: If a node's new parent is also its descendant
+        :raise: ValueError: If a node or new parent is unsaved, moved subtrees overlap, or a new
+            parent lies within a moved subtree
+        :raise: DoesNotExist: If a node or new parent no longer exists
+        """
+        moves = list(moves)
+
+        for node, parent in moves:
+            if node.pk is None or (parent is not None and parent.pk is None):
+                raise ValueError(
+                    "bulk_reparent() prohibited to prevent data loss due to an unsaved node or parent.")
+
+        moves = [(node, parent) for node, parent in moves
+                 if node.parent_id != (parent.pk if parent is not None else None)]
+
+        if not moves:
+            return
+
+        pks = {node.pk for node, _ in moves} | {parent.pk for _, parent in moves if parent is not None}
+
+        with transaction.atomic():
+            # Lock the rows whose paths the new paths are computed from, so a
+            # concurrent move cannot change them before the UPDATEs below.
+            paths = dict(cls.objects.select_for_update().filter(pk__in=pks).values_list('pk', 'path'))
+
+            missing = sorted(pks - paths.keys())
+            if missing:
+                raise cls.DoesNotExist(f"{cls.__name__} {missing} do not exist.")
+
+            old_prefixes = [xstr(paths[node.pk]) + cls.encode_base36_id(node.pk) for node, _ in moves]
+
+            new_paths = [
+                xstr(paths[parent.pk]) + cls.encode_base36_id(parent.pk) if parent is not None else None
+                for _, parent in moves
+            ]
+
+            # Do not allow your parent to be your child
+            for new_path, old_prefix in zip(new_paths, old_prefixes):
+                if new_path is not None and new_path.startswith(old_prefix):
+                    raise ValidationError(
+                        "A node's parent cannot also be its child.")
+
+            # Each node's new path is computed from the paths before the move, so no
+            # moved subtree may contain another moved node or a new parent.
+            for new_path in new_paths:
+                if new_path is not None and any(new_path.startswith(prefix) for prefix in old_prefixes):
+                    raise ValueError('A new parent cannot lie within another moved subtree.')
+
+            for i, old_prefix in enumerate(old_prefixes):
+                if any(i != j and old_prefix.startswith(prefix) for j, prefix in enumerate(old_prefixes)):
+                    raise ValueError('Moved subtrees cannot overlap.')
+
+            new_prefixes = [xstr(new_path) + cls.encode_base36_id(node.pk)
+                            for (node, _), new_path in zip(moves, new_paths)]
+
+            descendants = Q()
+            for old_prefix in old_prefixes:
+                descendants |= Q(path__startswith=old_prefix)
+
+            # bulk_update() casts its CASE expressions to the column types, which
+            # PostgreSQL needs when every new parent_id is NULL.
+            cls.objects.bulk_update([
+                cls(pk=node.pk, parent_id=parent.pk if parent is not None else None, path=new_path)
+                for (node, parent), new_path in zip(moves, new_paths)
+            ], ['parent', 'path'])
+            cls.objects.filter(descendants).update(
+                path=Case(*[
+                    When(path__startswith=old_prefix,
+                         then=Concat(Value(new_prefix), Substr(F('path'), len(old_prefix) + 1)))
+                    for old_prefix, new_prefix in zip(old_prefixes, new_prefixes)
+                ], default=F('path')),
+            )
+
+        for (node, parent), new_path in zip(moves, new_paths):
+            node.parent = parent
+            node.path = new_path
+            node._original_parent_id = node.parent_id
+
+    def _update_descendant_paths(self, old_prefix, new_prefix):
+        """
+        Rewrites the leading :old_prefix of every descendant path to :new_prefix. Subtrees larger
+        than path_update_batch_size are rewritten in batches of that many rows, ordered by pk.
+
+        :param old_prefix: The descendants search partial before the move
+        :param new_prefix: The descendants search partial after the move
+        """
+        descendants = self.__class__.objects.filter(path__startswith=old_prefix)
+
+        # The old prefix is always a prefix of every descendant path, so
+        # only the leading characters need rewriting.
+        new_path = Concat(Value(new_prefix), Substr(F('path'), len(old_prefix) + 1))
+
+        batch_size = self.path_update_batch_size
+        if not batch_size:
+            descendants.update(path=new_path)
+            return
+
+        count = descendants.count()
+        if not count:
+            # Leaf moves are the common case and have nothing to rewrite.
+            return
+
+        if count <= batch_size:
+            descendants.update(path=new_path)
+            return
+
+        # Bound each batch by a pk range rather than a list of pks, so no
+        # statement carries more than two parameters for the batch.
+        remaining = descendants
+        while True:
+            try:
+                last_pk = remaining.order_by('pk').values_list('pk', flat=True)[batch_size - 1]
+            except IndexError:
+                remaining.update(path=new_path)
+                return
+
+            remaining.filter(pk__lte=last_pk).update(path=new_path)
+            remaining = descendants.filter(pk__gt=last_pk)
+
+    def _get_parent_path(self):
+        """
+        :return: The path of the parent, read from the cached parent or fetched on its own
+        """
+        if self._meta.get_field('parent').is_cached(self):
+            return self.parent.path
+
+        return self.__class__.objects.values_list('path', flat=True).get(pk=self.parent_id)
+
+    def _get_original_parent_id(self):
+        """
+        :return: The parent_id when loaded or last saved, fetched if it was deferred on load
+        """
+        if self._original_parent_id is DEFERRED:
+            self._original_parent_id = self.__class__.objects.values_list(
+                'parent_id', flat=True).get(pk=self.pk)
+
+        return self._original_parent_id
+
     def save(self, *args, **kwargs):
 
+        # A parent assigned before it was saved leaves parent_id unset until
+        # Model.save() copies its pk, which happens after the path is built here.
+        parent = self._meta.get_field('parent').get_cached_value(self, None)
+        if self.parent_id is None and parent is not None and parent.pk is not None:
+            self.parent = parent
+
         if self._state.adding is True:
-            if not getattr(self, 'parent', None):
+            if not self.parent_id:
                 self.path = None
-            elif getattr(self.parent, 'path', None):
-                self.path = self.parent.path + \
-                    self.encode_base36_id(self.parent.id)
             else:
-                self.path = self.encode_base36_id(self.parent.id)
+                self.path = xstr(self._get_parent_path()) + \
+                    self.encode_base36_id(self.parent_id)
 
-        elif self._original_parent_id != self.parent_id:
+            super().save(*args, **kwargs)
+
+        elif self._get_original_parent_id() != self.parent_id:
 
             b36str = self.encode_base36_id(self.id)
-            search_partial = xstr(self.path) + b36str
-            remove_partial = xstr(self.path)
+            old_prefix = xstr(self.path) + b36str
 
             if self.parent_id:
 
-                self.path = xstr(self.parent.path) + \
+                self.path = xstr(self._get_parent_path()) + \
                     self.encode_base36_id(self.parent_id)
 
                 # Do not allow your parent to be your child
-                parent_ids = self.decode_path_to_ids(self.path)
-                if self.id in parent_ids:
+                if self.id in self._ids():
                     raise ValidationError(
                         "A node's parent cannot also be its child.")
             else:
                 self.path = None
 
-            self.__class__.objects.filter(path__startswith=search_partial).update(
-                path=Func(
-                    F('path'),
-                    Value(remove_partial), Value(self.path),
-                    function='replace',
-                )
-            )
+            new_prefix = xstr(self.path) + b36str
 
-        super().save(*args, **kwargs)
+            # Keep descendant paths and self consistent if any statement fails.
+            with transaction.atomic():
+                self._update_descendant_paths(old_prefix, new_prefix)
+                super().save(*args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
+
+        self._original_parent_id = self.parent_id
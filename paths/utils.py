@@ -1,4 +1,7 @@
-def base36encode(num):
+_DIGITS = b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+def base36encode(num, _digits=_DIGITS):
     """Converts a positive integer into a base36 string."""
 
     if not isinstance(num, int):
@@ -7,13 +10,17 @@ def base36encode(num):
     if not num >= 0:
         raise ValueError('Negative integers are not permitted for base36encode.')
 
-    digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    if num == 0:
+        return '0'
 
-    res = ''
-    while not res or num > 0:
+    # Fill a single buffer least significant digit first and reverse it once,
+    # rather than prepending to a new string on every iteration.
+    buf = bytearray()
+    while num:
         num, i = divmod(num, 36)
-        res = digits[i] + res
-    return res
+        buf.append(_digits[i])
+    buf.reverse()
+    return buf.decode('ascii')
 
 
 def base36decode(base36_string):
@@ -21,6 +28,42 @@ def base36decode(base36_string):
     return int(base36_string, 36)
 
 
+def _base36_path_decode(buf, _int=int):
+    """Decodes length-prefixed base36 ids from ASCII bytes into a list of integers."""
+
+    # The length prefix is a single digit, so it can be read by subtracting
+    # ord('0') instead of calling int().
+    ids = []
+    append = ids.append
+    end = len(buf)
+    cursor = 0
+
+    while cursor < end:
+        length = buf[cursor] - 0x30
+        if not 1 <= length <= 9:
+            raise ValueError("Invalid length prefix in path.")
+
+        start = cursor + 1
+        cursor = start + length
+        if cursor > end:
+            raise ValueError("Truncated path.")
+
+        # int() also accepts signs, whitespace and underscores, which are not base36 digits.
+        segment = buf[start:cursor]
+        if not segment.isalnum():
+            raise ValueError("Invalid base36 digit in path.")
+
+        append(_int(segment, 36))
+
+    return ids
+
+
+try:
+    from paths._decode import decode as base36_path_decode
+except ImportError:
+    base36_path_decode = _base36_path_decode
+
+
 def xstr(s):
     if s is None:
         return ''
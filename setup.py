@@ -1,16 +1,31 @@
 import os
-from setuptools import find_packages, setup
+from setuptools import Extension, find_packages, setup
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
 
 with open(os.path.join(os.path.dirname(__file__), 'README.md')) as readme:
     README = readme.read()
 
 os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 
+# The compiled path decoder is optional; paths.utils falls back to pure Python without it.
+ext_modules = []
+if cythonize is not None:
+    ext_modules = cythonize([Extension('paths._decode', ['paths/_decode.pyx'])])
+    # cythonize() returns new Extension objects without the optional flag, so
+    # set it afterwards; a missing compiler then only skips the extension.
+    for ext in ext_modules:
+        ext.optional = True
+
 setup(
     name='django-materialized-paths',
     version='0.1',
     packages=find_packages(),
     include_package_data=True,
+    ext_modules=ext_modules,
     license='MIT License',
     description='A simple and lightweight implementation of materialized path tree structures in Django.',
     long_description=README,
@@ -1,5 +1,8 @@
+from unittest import mock
+
 from django.test import TestCase
 from django.core.exceptions import ValidationError
+from django.db.models import Func, Subquery
 from .models import Folder
 
 
@@ -33,6 +36,11 @@ class TestBaseNode(TestCase):
     def test_decode_path_to_ids_with_null_path(self):
         self.assertListEqual([], Folder.decode_path_to_ids(None))
 
+    def test_decode_path_to_ids_round_trip(self):
+        ids = [1, 35, 36, 1295, 123456, 2 ** 40]
+        path = Folder.encode_ids_to_path(ids)
+        self.assertListEqual(ids, Folder.decode_path_to_ids(path))
+
     def test_created_as_leaf(self):
         root, leaf = self.create_subtree_with_x_levels(2)
 
@@ -41,6 +49,35 @@ class TestBaseNode(TestCase):
         self.assertEquals(expected_parent_id, leaf.parent_id)
         self.assertEquals(expected_path, leaf.path)
 
+    def test_created_with_parent_id(self):
+        root, sub_node_a = self.create_subtree_with_x_levels(2)
+
+        with self.assertNumQueries(2):
+            leaf = Folder.objects.create(parent_id=sub_node_a.id)
+
+        self.assertEquals(Folder.encode_ids_to_path([root.id, sub_node_a.id]), leaf.path)
+
+    def test_created_with_parent_saved_after_assignment(self):
+        root = Folder()
+        leaf = Folder(parent=root)
+        root.save()
+        leaf.save()
+        leaf.refresh_from_db()
+
+        self.assertEquals(root.id, leaf.parent_id)
+        self.assertEquals(Folder.encode_ids_to_path([root.id]), leaf.path)
+
+    def test_moved_to_parent_saved_after_assignment(self):
+        root_a, sub_node_a = self.create_subtree_with_x_levels(2)
+        root_b = Folder()
+        sub_node_a.parent = root_b
+        root_b.save()
+        sub_node_a.save()
+        sub_node_a.refresh_from_db()
+
+        self.assertEquals(root_b.id, sub_node_a.parent_id)
+        self.assertEquals(Folder.encode_ids_to_path([root_b.id]), sub_node_a.path)
+
     def test_delete_cascades(self):
         root, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
 
@@ -61,6 +98,14 @@ class TestBaseNode(TestCase):
 
         self.assertIsNone(sub_node_a.path)
 
+    def test_move_leaf_skips_descendant_update(self):
+        root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
+        sub_node_aa.parent = root_a
+
+        # Descendant count and own UPDATE, wrapped in a savepoint
+        with self.assertNumQueries(4):
+            sub_node_aa.save()
+
     def test_move_leaf_to_leaf(self):
         root, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
         self.reset_parent_to(sub_node_aa, root)
@@ -90,6 +135,57 @@ class TestBaseNode(TestCase):
         self.assertEquals(expected_parent_id, root_a.parent_id)
         self.assertEquals(expected_path, root_a.path)
 
+    def test_move_root_to_subtree_updates_descendants(self):
+        root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
+        root_b, sub_node_b, sub_node_bb = self.create_subtree_with_x_levels(3)
+        self.reset_parent_to(root_a, sub_node_b)
+        sub_node_aa.refresh_from_db()
+
+        expected_path = Folder.encode_ids_to_path([root_b.id, sub_node_b.id, root_a.id, sub_node_a.id])
+        self.assertEquals(expected_path, sub_node_aa.path)
+
+    def test_move_large_subtree_updates_descendants_in_batches(self):
+        root_a, sub_node_a, sub_node_aa, sub_node_aaa = self.create_subtree_with_x_levels(4)
+        root_b = Folder.objects.create()
+
+        with mock.patch.object(Folder, 'path_update_batch_size', 1):
+            self.reset_parent_to(sub_node_a, root_b)
+
+        sub_node_aa.refresh_from_db()
+        sub_node_aaa.refresh_from_db()
+        self.assertEquals(Folder.encode_ids_to_path([root_b.id, sub_node_a.id]), sub_node_aa.path)
+        self.assertEquals(Folder.encode_ids_to_path([root_b.id, sub_node_a.id, sub_node_aa.id]), sub_node_aaa.path)
+
+    def test_move_with_deferred_parent(self):
+        root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
+        root_b = Folder.objects.create()
+
+        sub_node_a = Folder.objects.defer('parent').get(pk=sub_node_a.pk)
+        self.reset_parent_to(sub_node_a, root_b)
+        sub_node_aa.refresh_from_db()
+
+        self.assertEquals(Folder.encode_ids_to_path([root_b.id]), sub_node_a.path)
+        self.assertEquals(Folder.encode_ids_to_path([root_b.id, sub_node_a.id]), sub_node_aa.path)
+
+    def test_save_twice_after_create_does_not_move(self):
+        root_a, sub_node_a = self.create_subtree_with_x_levels(2)
+
+        with self.assertNumQueries(1):
+            sub_node_a.save()
+
+    def test_save_after_bulk_create_does_not_move(self):
+        root_a, sub_node_a = self.create_subtree_with_x_levels(2)
+        path = Folder.encode_ids_to_path([root_a.id, sub_node_a.id])
+        sub_node_aa, = Folder.objects.bulk_create([Folder(parent=sub_node_a, path=path)])
+        sub_node_aaa = Folder.objects.create(parent=sub_node_aa)
+
+        # The original parent_id SELECT and own UPDATE, with no descendant rewrite
+        with self.assertNumQueries(2):
+            sub_node_aa.save()
+
+        sub_node_aaa.refresh_from_db()
+        self.assertEquals(Folder.encode_ids_to_path([root_a.id, sub_node_a.id, sub_node_aa.id]), sub_node_aaa.path)
+
     def test_move_root_to_own_subtree_should_error(self):
         root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
 
@@ -107,6 +203,67 @@ class TestBaseNode(TestCase):
         self.assertEquals(expected_parent_id, sub_node_a.parent_id)
         self.assertEquals(expected_path, sub_node_a.path)
 
+    def test_bulk_reparent(self):
+        root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
+        root_b, sub_node_b, sub_node_bb, sub_node_bbb = self.create_subtree_with_x_levels(4)
+
+        # One SELECT and two UPDATEs, wrapped in a savepoint
+        with self.assertNumQueries(5):
+            Folder.bulk_reparent([(sub_node_a, sub_node_b), (sub_node_bb, None)])
+
+        self.assertEquals(sub_node_b.id, sub_node_a.parent_id)
+        self.assertIsNone(sub_node_bb.parent_id)
+        self.assertEquals(Folder.encode_ids_to_path([root_b.id, sub_node_b.id]), sub_node_a.path)
+        self.assertIsNone(sub_node_bb.path)
+
+        for node in (sub_node_a, sub_node_bb):
+            expected_path = node.path
+            node.refresh_from_db()
+            self.assertEquals(expected_path, node.path)
+
+        sub_node_aa.refresh_from_db()
+        sub_node_bbb.refresh_from_db()
+        self.assertEquals(Folder.encode_ids_to_path([root_b.id, sub_node_b.id, sub_node_a.id]), sub_node_aa.path)
+        self.assertEquals(Folder.encode_ids_to_path([sub_node_bb.id]), sub_node_bbb.path)
+
+    def test_bulk_reparent_all_to_root(self):
+        root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
+        root_b, sub_node_b = self.create_subtree_with_x_levels(2)
+
+        Folder.bulk_reparent([(sub_node_a, None), (sub_node_b, None)])
+
+        for node in (sub_node_a, sub_node_b):
+            node.refresh_from_db()
+            self.assertIsNone(node.parent_id)
+            self.assertIsNone(node.path)
+
+        sub_node_aa.refresh_from_db()
+        self.assertEquals(Folder.encode_ids_to_path([sub_node_a.id]), sub_node_aa.path)
+
+    def test_bulk_reparent_with_unsaved_or_missing_nodes(self):
+        root_a, sub_node_a = self.create_subtree_with_x_levels(2)
+
+        with self.assertRaises(ValueError):
+            Folder.bulk_reparent([(sub_node_a, Folder())])
+
+        with self.assertRaises(ValueError):
+            Folder.bulk_reparent([(Folder(), root_a)])
+
+        root_b = Folder.objects.create()
+        Folder.objects.filter(pk=root_b.pk).delete()
+        with self.assertRaises(Folder.DoesNotExist):
+            Folder.bulk_reparent([(sub_node_a, root_b)])
+
+    def test_bulk_reparent_to_own_subtree_should_error(self):
+        root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
+        root_b = Folder.objects.create()
+
+        with self.assertRaises(ValidationError):
+            Folder.bulk_reparent([(root_a, sub_node_aa)])
+
+        with self.assertRaises(ValueError):
+            Folder.bulk_reparent([(root_a, root_b), (sub_node_a, root_b)])
+
     def test_get_ancestors_ids(self):
         root_a, sub_node_a, sub_node_aa, sub_node_aaa = self.create_subtree_with_x_levels(4)
         expected_list = [root_a.id, sub_node_a.id, sub_node_aa.id]
@@ -115,6 +272,16 @@ class TestBaseNode(TestCase):
         expected_list.append(sub_node_aaa.id)
         self.assertListEqual(expected_list, sub_node_aaa.get_ancestors_ids(include_self=True))
 
+    def test_get_ancestors_ids_after_move(self):
+        root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
+        root_b = Folder.objects.create()
+
+        self.assertListEqual([root_a.id, sub_node_a.id], sub_node_aa.get_ancestors_ids())
+        sub_node_aa.get_ancestors_ids(include_self=True)
+        self.assertListEqual([root_a.id, sub_node_a.id], sub_node_aa.get_ancestors_ids())
+        self.reset_parent_to(sub_node_aa, root_b)
+        self.assertListEqual([root_b.id], sub_node_aa.get_ancestors_ids())
+
     def test_get_descendants_ids(self):
         root_a, sub_node_a, sub_node_aa, sub_node_aaa = self.create_subtree_with_x_levels(4)
         expected_list = [sub_node_a.id, sub_node_aa.id, sub_node_aaa.id]
@@ -127,6 +294,40 @@ class TestBaseNode(TestCase):
         self.assertIsNone(root_a.get_ancestors())
         self.assertListEqual(expected_list, list(sub_node_aaa.get_ancestors()))
 
+    def test_get_ancestors_ordered(self):
+        root_a, sub_node_a, sub_node_aa, sub_node_aaa = self.create_subtree_with_x_levels(4)
+        self.assertListEqual([], root_a.get_ancestors_ordered())
+        with self.assertNumQueries(1):
+            self.assertListEqual([root_a, sub_node_a, sub_node_aa], sub_node_aaa.get_ancestors_ordered())
+        with self.assertNumQueries(0):
+            self.assertEqual(sub_node_a, sub_node_aaa.get_ancestor(1))
+
+    def test_get_ancestors_ordered_with_missing_ancestor(self):
+        root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
+        sub_node_a.delete()
+
+        with self.assertRaises(Folder.DoesNotExist):
+            sub_node_aa.get_ancestors_ordered()
+
+    def test_ancestors_of(self):
+        root_a, sub_node_a, sub_node_aa, sub_node_aaa = self.create_subtree_with_x_levels(4)
+        root_b, sub_node_b = self.create_subtree_with_x_levels(2)
+        sub_node_ab = Folder.objects.create(parent=root_a)
+        Folder.objects.create(parent=sub_node_ab)
+        sub_node_a.parent = sub_node_ab
+        sub_node_a.save()
+
+        nodes = Folder.objects.annotate(
+            root_id=Subquery(Folder.objects.ancestors_of().filter(parent=None).values('id')[:1]),
+            ancestor_count=Subquery(
+                Folder.objects.ancestors_of().annotate(n=Func('id', function='COUNT')).values('n')),
+        ).order_by('id')
+
+        self.assertListEqual(
+            [(None, 0), (root_a.id, 2), (root_a.id, 3), (root_a.id, 4), (None, 0), (root_b.id, 1),
+             (root_a.id, 1), (root_a.id, 2)],
+            [(node.root_id, node.ancestor_count) for node in nodes])
+
     def test_get_descendants(self):
         root_a, sub_node_a, sub_node_aa, sub_node_aaa = self.create_subtree_with_x_levels(4)
         expected_list = [sub_node_a, sub_node_aa, sub_node_aaa]
@@ -142,6 +343,11 @@ class TestBaseNode(TestCase):
         expected_root = root_a
         self.assertEqual(expected_root, sub_node_aa.get_root())
 
+    def test_get_root_id(self):
+        root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
+        self.assertEqual(root_a.id, root_a.get_root_id())
+        self.assertEqual(root_a.id, sub_node_aa.get_root_id())
+
     def test_get_siblings_if_none_exist(self):
         root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
         self.assertIsNone(sub_node_a.get_siblings())
@@ -168,6 +374,11 @@ class TestBaseNode(TestCase):
         self.assertEqual(1, sub_node_a.depth)
         self.assertEqual(2, sub_node_aa.depth)
 
+    def test_get_depth_rejects_invalid_length_prefix(self):
+        for path in ('/1', '1A01', '1A-1'):
+            with self.subTest(path=path), self.assertRaises(ValueError):
+                Folder(path=path).depth
+
     def test_get_ancestor(self):
         root_a, sub_a, sub_aa, sub_aaa, sub_aaaa = self.create_subtree_with_x_levels(5)
 
@@ -179,6 +390,12 @@ class TestBaseNode(TestCase):
         self.assertEqual(sub_a, sub_aaaa.get_ancestor(1))
         self.assertEqual(sub_aaaa, sub_aaaa.get_ancestor(4))
 
+    def test_get_ancestor_at_own_depth_beyond_small_ints(self):
+        node = Folder(path=Folder.encode_ids_to_path(range(1, 301)))
+
+        with self.assertNumQueries(0):
+            self.assertIs(node, node.get_ancestor(int('300')))
+
     def test_is_child_of(self):
         root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
 
@@ -186,9 +403,34 @@ class TestBaseNode(TestCase):
         self.assertFalse(sub_node_a.is_child_of(sub_node_a.id))
         self.assertTrue(sub_node_aa.is_child_of(root_a.id))
 
+    def test_is_child_of_matches_whole_segments_only(self):
+        node = Folder(path=Folder.encode_ids_to_path([37, 2]))
+
+        self.assertTrue(node.is_child_of(37))
+        self.assertTrue(node.is_child_of(2))
+        self.assertFalse(node.is_child_of(1))
+
+    def test_is_child_of_with_invalid_ancestor_id(self):
+        node = Folder(path=Folder.encode_ids_to_path([37, 2]))
+
+        self.assertFalse(node.is_child_of('37'))
+        self.assertFalse(node.is_child_of(None))
+        self.assertFalse(node.is_child_of(-2))
+
+    def test_is_child_of_rejects_invalid_length_prefix(self):
+        with self.assertRaises(ValueError):
+            Folder(path='/1').is_child_of(1)
+
     def test_has_children(self):
         root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
 
         self.assertTrue(root_a.has_children())
         self.assertTrue(sub_node_a.has_children())
         self.assertFalse(sub_node_aa.has_children())
+
+    def test_has_children_with_annotation(self):
+        root_a, sub_node_a, sub_node_aa = self.create_subtree_with_x_levels(3)
+
+        with self.assertNumQueries(1):
+            nodes = list(Folder.objects.with_has_children().order_by('id'))
+            self.assertListEqual([True, True, False], [node.has_children() for node in nodes])
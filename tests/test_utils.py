@@ -1,5 +1,11 @@
+import importlib
+import sys
+from unittest import mock
+
 from django.test import TestCase
-from paths.utils import base36encode
+
+import paths.utils
+from paths.utils import _base36_path_decode, base36_path_decode, base36encode
 
 
 class TestUtils(TestCase):
@@ -10,3 +16,29 @@ class TestUtils(TestCase):
 
         with self.assertRaises(ValueError):
             base36encode(-1)
+
+    def test_base36encode_values(self):
+        self.assertEqual('0', base36encode(0))
+        self.assertEqual('Z', base36encode(35))
+        self.assertEqual('10', base36encode(36))
+        self.assertEqual('2N9C', base36encode(123456))
+
+    def test_base36_path_decode(self):
+        self.assertListEqual([], base36_path_decode(b''))
+        self.assertListEqual([1, 36, 123456], base36_path_decode(b'11210'b'42N9C'))
+        self.assertListEqual([1, 36, 123456], _base36_path_decode(b'11210'b'42N9C'))
+
+    def test_base36_path_decode_rejects_malformed_paths(self):
+        for decode in (base36_path_decode, _base36_path_decode):
+            for path in (b'2A', b'0', b'/1', b'1+', b'1 ', b'3A_B', b'1\xc3'):
+                with self.subTest(decode=decode, path=path), self.assertRaises(ValueError):
+                    decode(path)
+
+    def test_base36_path_decode_falls_back_without_extension(self):
+        try:
+            with mock.patch.dict(sys.modules, {'paths._decode': None}):
+                utils = importlib.reload(paths.utils)
+                self.assertIs(utils._base36_path_decode, utils.base36_path_decode)
+                self.assertListEqual([1, 36], utils.base36_path_decode(b'11210'))
+        finally:
+            importlib.reload(paths.utils)